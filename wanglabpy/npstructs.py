@@ -10,11 +10,15 @@ import numpy as np
 import pims
 import skimage, skimage.io, skimage.morphology
 import skimage.filters, skimage.feature
-import skimage.measure
+import skimage.measure, skimage.util
 from scipy import ndimage as ndi
 from skimage.segmentation import watershed
 import pandas as pd
 import multiprocessing as mps
+import functools
+import inspect
+from multiprocessing import shared_memory
+from numba import njit
 
 
 
@@ -33,43 +37,89 @@ def comp2img(img1, img2, cmap1='gray', cmap2='gray', vminmax1=None, vminmax2=Non
     else:
         plt.imshow(img2, cmap=cmap2, vmin=vminmax2[0], vmax=vminmax2[1])
 
-def background_subtraction(image, ball_size=9):
+@functools.lru_cache(maxsize=16)
+def _disk(ball_size):
+    ''' disk-shaped structuring element, cached by `ball_size` (do not modify the returned array)
+    '''
+    return skimage.morphology.disk(ball_size)
+
+# `out` of skimage.filters.gaussian only exists in skimage>=0.23
+_GAUSSIAN_HAS_OUT = 'out' in inspect.signature(skimage.filters.gaussian).parameters
+
+def background_subtraction(image, ball_size=9, out=None):
     ''' rolling-ball background subtraction
     PARAMETERS
         image:      (array) input image 
         ball_size:  (int) ball size (in unit of pixels)
+        out:        (array) optional array (same shape and dtype as image) in which to store the output
     RETURNS
         image_rmbg: (array) output image with background removed
     '''
-    image_rmbg = skimage.morphology.white_tophat(image, selem=skimage.morphology.disk(ball_size))
+    if out is None:
+        image_rmbg = skimage.morphology.white_tophat(image, _disk(ball_size))
+    else:
+        image_rmbg = skimage.morphology.white_tophat(image, _disk(ball_size), out=out)
     return image_rmbg
 
-def smooth_image(image, sigma=1, times=1):
+def smooth_image(image, sigma=1, times=1, out=None):
     ''' smooth image by x times (using gaussian filter)
     PARAMETERS
         image:  (array) input image
         sigma:  (int/float) size of the gaussian filter
         times:  (int) number of times for smoothing
+        out:    (array) optional float array (same shape as image) in which to store the output
     RETURNS
         image_sm: (array) output image after smoothing
     '''
-    image_sm = image.copy()
-    for i in range(times):
-        image_sm = skimage.filters.gaussian(image_sm,sigma=sigma)
+    if times < 1:
+        if out is None:
+            return image.copy()
+        np.copyto(out, image)
+        return out
+    # applying a gaussian of sigma `times` times equals a single gaussian of sigma*sqrt(times)
+    sigma_eff = sigma*np.sqrt(times)
+    if out is None:
+        image_sm = skimage.filters.gaussian(image, sigma=sigma_eff)
+    elif _GAUSSIAN_HAS_OUT:
+        image_sm = skimage.filters.gaussian(image, sigma=sigma_eff, out=out)
+    else:
+        np.copyto(out, skimage.filters.gaussian(image, sigma=sigma_eff))
+        image_sm = out
     return image_sm
 
-def scale_image_intensity(image, scfactor=1.0):
+def scale_image_intensity(image, scfactor=1.0, out=None):
     ''' scale the intensity of an image
     '''
-    return image*scfactor
+    return np.multiply(image, scfactor, out=out)
 
-def bwimage_by_threshold(image, threshold=180):
+def bwimage_by_threshold(image, threshold=180, out=None):
     ''' create a black/white image by applying a threshold
     '''
-    return (image>=threshold)*1.0
+    if out is None:
+        return (image>=threshold)*1.0
+    return np.greater_equal(image, threshold, out=out)
+
+@njit(cache=True)
+def _scale_threshold(image, scfactor, threshold, out):
+    ''' fused `bwimage_by_threshold(scale_image_intensity(image, scfactor), threshold)`, writing a bool image to `out`
+    (serial, as frames are processed in parallel by `locate_nps_multiple_images(...)`)
+    '''
+    for i in range(image.shape[0]):
+        for j in range(image.shape[1]):
+            out[i,j] = image[i,j]*scfactor >= threshold
+
+def _get_buffer(out, key, shape):
+    ''' get the buffer `key` from the dict `out` (see `preprocess_image(...)`) if it can be reused for `shape`
+    '''
+    if out is None:
+        return None
+    buf = out.get(key)
+    if buf is None or buf.shape != shape:
+        return None
+    return buf
 
 def preprocess_image(image, ball_size=9, sigma=1, times=2, scfactor=1e5,
-                    threshold=180, output_detail=False):
+                    threshold=180, output_detail=False, out=None):
     ''' preprocess an image and generate a black/white image of structures, which will be used for finding structures in `find_structs(...)`
     Steps of the preprocess include:
         1) background subtraction by rolling-ball algorithm
@@ -85,25 +135,93 @@ def preprocess_image(image, ball_size=9, sigma=1, times=2, scfactor=1e5,
         scfactor:   (float) scaling factor for intensity scaling
         threshold:  (float) threshold for generating the black/white image
         output_detail:  (bool) indicate whether to return details
+        out:        (dict) optional buffers for the intermediate images, to be reused across frames.
+                    Start with an empty dict: the buffers are allocated on the first call and stored
+                    in `out` under the names below; later calls with frames of the same shape write
+                    into them. Note that the returned arrays are overwritten by the next call.
     RETURNS
         if output_detail is False:
-          bwimage:  (numpy.array) black/white image
+          bwimage:  (numpy.array:bool) black/white image
         if output_detail is True:
           detailed_output: (bwimage, image_rmbg, image_sm, image_sm_rmbg, image_sm_rmbg_sc)
-
+    NOTE: all the intermediate images are float32. Integer images are first rescaled to [0,1]
+          (as `skimage.filters.gaussian` would do), so `scfactor` and `threshold` keep their meaning.
+          In particular, `image_rmbg` in the detailed output is float32 in [0,1] for integer images,
+          not the integer dtype of the input image.
     '''
-    image_rmbg = background_subtraction(image, ball_size)
-    image_sm = smooth_image(image_rmbg, sigma, times)
-    image_sm_rmbg = background_subtraction(image_sm, ball_size)
-    image_sm_rmbg_sc = scale_image_intensity(image_sm_rmbg, scfactor)
-    bwimage = bwimage_by_threshold(image_sm_rmbg_sc, threshold)
+    image = np.ascontiguousarray(skimage.util.img_as_float32(image))
+    shape = np.shape(image)
+    image_rmbg = background_subtraction(image, ball_size,
+                    out=_get_buffer(out, 'image_rmbg', shape))
+    image_sm = smooth_image(image_rmbg, sigma, times,
+                    out=_get_buffer(out, 'image_sm', shape))
+    image_sm_rmbg = background_subtraction(image_sm, ball_size,
+                    out=_get_buffer(out, 'image_sm_rmbg', shape))
+    # scaling and thresholding in a single pass, without the scaled image
+    bwimage = _get_buffer(out, 'bwimage', shape)
+    if bwimage is None:
+        bwimage = np.empty(shape, dtype=bool)
+    _scale_threshold(image_sm_rmbg, scfactor, threshold, bwimage)
+    if out is not None:
+        out.update({'image_rmbg': image_rmbg, 'image_sm': image_sm, 'image_sm_rmbg': image_sm_rmbg,
+                    'bwimage': bwimage})
     if output_detail:
+        image_sm_rmbg_sc = scale_image_intensity(image_sm_rmbg, scfactor)
         return (bwimage, image_rmbg, image_sm, image_sm_rmbg, image_sm_rmbg_sc)
     else:
         return bwimage
 
 
 
+def square_erosion(image, size):
+    ''' erosion with a square structuring element of size x size pixels
+    The square is separable, so the erosion is done as two 1D min filters
+    (along rows, then along columns), which is O(N) regardless of `size`.
+    Equivalent to `skimage.morphology.erosion(image, skimage.morphology.square(size))`.
+    '''
+    # skimage anchors even-sized squares one pixel off from scipy
+    o = -1 if size%2==0 else 0
+    erosed = ndi.grey_erosion(image, size=(size,1), origin=(o,0))
+    return ndi.grey_erosion(erosed, size=(1,size), origin=(0,o))
+
+@njit(cache=True)
+def _is_edge(bwimage, y, x):
+    ''' whether the sobel gradient of `bwimage` at (y, x) is nonzero (borders are reflected)
+    '''
+    ny, nx = bwimage.shape
+    y0 = max(y-1, 0)
+    y1 = min(y+1, ny-1)
+    x0 = max(x-1, 0)
+    x1 = min(x+1, nx-1)
+    gy = (bwimage[y0,x0] + 2*bwimage[y0,x] + bwimage[y0,x1]) - (bwimage[y1,x0] + 2*bwimage[y1,x] + bwimage[y1,x1])
+    gx = (bwimage[y0,x0] + 2*bwimage[y,x0] + bwimage[y1,x0]) - (bwimage[y0,x1] + 2*bwimage[y,x1] + bwimage[y1,x1])
+    return gy != 0 or gx != 0
+
+@njit(cache=True)
+def _edge_dilate(bwimage, size, out):
+    ''' fused `skimage.filters.sobel(bwimage)>0` followed by a dilation with a size x size square
+    Each row of `out` only needs a single row buffer of the edges found in its vertical window,
+    so no full-frame edge image is allocated. The kernel is serial on purpose: frames are already
+    processed in parallel by `locate_nps_multiple_images(...)`.
+    '''
+    ny, nx = bwimage.shape
+    lo = (size-1)//2
+    hi = size//2
+    colany = np.empty(nx, dtype=np.bool_)
+    for y in range(ny):
+        colany[:] = False
+        for yy in range(max(y-lo, 0), min(y+hi+1, ny)):
+            for x in range(nx):
+                if not colany[x] and _is_edge(bwimage, yy, x):
+                    colany[x] = True
+        for x in range(nx):
+            v = False
+            for xx in range(max(x-lo, 0), min(x+hi+1, nx)):
+                if colany[xx]:
+                    v = True
+                    break
+            out[y,x] = v
+
 def find_structs(bwimage, dilation_size=3, erosion_size=4, min_struct_size=32, output_detail=False):
     ''' find structures from a black-white image
     PARAMETERS
@@ -118,16 +236,15 @@ def find_structs(bwimage, dilation_size=3, erosion_size=4, min_struct_size=32, o
         if output_detail is True:
           detailed_output: tuple of (struct_labels, edges, dilated, smallobjremoved, filled, erosed, smallobjremoved2, markers)
     '''
-    # find raw edges
-    edges = skimage.filters.sobel(bwimage) > 0
-    # dilate edges to fill possible gaps
-    dilated = skimage.morphology.dilation(edges, skimage.morphology.square(dilation_size))
+    # find raw edges and dilate them to fill possible gaps (in a single pass)
+    dilated = np.empty(np.shape(bwimage), dtype=bool)
+    _edge_dilate(np.ascontiguousarray(bwimage), dilation_size, dilated)
     # remove small objects of dilated edges
     smallobjremoved = skimage.morphology.remove_small_objects(dilated.astype(bool), min_size=min_struct_size)
     # fill the edges
-    filled = 1 - skimage.morphology.flood(smallobjremoved.astype('uint16'), (0,0))
+    filled = ndi.binary_fill_holes(smallobjremoved)
     # erose the filled structs
-    erosed = skimage.morphology.erosion(filled, skimage.morphology.square(erosion_size))
+    erosed = square_erosion(filled, erosion_size)
     # remove small objects of erosed structs
     smallobjremoved2 = skimage.morphology.remove_small_objects(erosed.astype(bool), min_size=min_struct_size)
     # label the structs
@@ -135,11 +252,12 @@ def find_structs(bwimage, dilation_size=3, erosion_size=4, min_struct_size=32, o
     struct_labels = watershed(np.zeros_like(smallobjremoved2), markers, mask=smallobjremoved2)
     # return 
     if output_detail:
+        edges = skimage.filters.sobel(bwimage) > 0
         return (struct_labels, edges, dilated, smallobjremoved, filled, erosed, smallobjremoved2, markers)
     else:
         return struct_labels
 
-def annotate_structs(image, struct_labels, fig=None, vmin=None, vmax=None, add_text=False, colors=None):
+def annotate_structs(image, struct_labels, fig=None, vmin=None, vmax=None, add_text=False, colors=None, contours=None):
     ''' annotate the structures of silver nanoparticles on top of the image
     PARAMETERS
         image:          (array) image from which the structures are found
@@ -147,6 +265,8 @@ def annotate_structs(image, struct_labels, fig=None, vmin=None, vmax=None, add_t
         fig:            (int) figure id on which the figure is shown
         vmin/vmax:      (float) intensity parameters for showing the image. See `matplotplib.pyplot.imshow`
         add_text:       (bool) add text (structure id) to the annotated figure if add_text is True
+        contours:       (list) contours of the structures, i.e. `skimage.measure.find_contours(struct_labels, 0)`;
+                        computed here if None. Pass them in to avoid recomputing when they are also used elsewhere
     RETURNS
         fig:            (int) figure id on which the figure is shown, could be useful if one wants to modify the figure
     '''
@@ -155,7 +275,8 @@ def annotate_structs(image, struct_labels, fig=None, vmin=None, vmax=None, add_t
     else:
         fig = plt.figure(fig)
     plt.imshow(image, cmap='gray', vmin=vmin, vmax=vmax)
-    contours = skimage.measure.find_contours(struct_labels, 0)
+    if contours is None:
+        contours = skimage.measure.find_contours(struct_labels, 0)
     for n, contour in enumerate(contours):
         if colors is None:
             p = plt.plot(contour[:,1], contour[:,0])
@@ -178,56 +299,68 @@ def get_struct_sizes(struct_labels):
     n_structs = np.max(struct_labels)
     if n_structs == 0:
         return [0]
-    sizes = []
-    for i in range(1, n_structs):
-        sizes.append(np.sum(struct_labels==i))
-    return sizes
+    # one pass over the labels; index 0 is the background
+    counts = np.bincount(np.ravel(struct_labels), minlength=n_structs+1)
+    return counts[1:].tolist()
 
-def get_struct_cms(struct_labels, to_plot=False):
+def get_struct_cms(struct_labels, to_plot=False, contours=None):
     ''' get the center-of-masses of the structures of silver nanoparticles
     PARAMETERS
         struct_labels:  (numpy.array) labels of structures, same size of the image, obtained from `find_structs(...)`
         to_plot:        (bool) plot the center-of-masses if to_plot is True
+        contours:       (list) contours of the structures for plotting, see `annotate_structs(...)`
     RETURNS
         cms:            (numpy.array) position [x,y] of the center-of-masses
     '''
-    contours = skimage.measure.find_contours(struct_labels, 0)
-    cms = []
+    props = skimage.measure.regionprops_table(struct_labels, properties=('centroid',))
+    cms = np.stack([props['centroid-0'], props['centroid-1']], axis=1)
     if to_plot is True:
         plt.figure(figsize=(6,6))
-    for n, contour in enumerate(contours):
-        cms.append([np.mean(contour[:,0]), np.mean(contour[:,1])])
-        if to_plot is True:
-            c = plt.plot(contour[:,0], contour[:,1], '-')
-            plt.plot([np.mean(contour[:,0])], [np.mean(contour[:,1])],
-                    'x', color=c[0].get_color())
-    if to_plot is True:
+        if contours is None:
+            contours = skimage.measure.find_contours(struct_labels, 0)
+        for contour in contours:
+            plt.plot(contour[:,0], contour[:,1], '-')
+        plt.plot(cms[:,0], cms[:,1], 'x', color='k')
         plt.gca().set_aspect(1)
-    return np.array(cms)
+    return cms
 
 def polyarea(x, y):
     ''' calculate the area of a polygon (specified by vertices x, y) using the Shoelace formula
     '''
-    return 0.5*np.abs(np.dot(x,np.roll(y,1))-np.dot(y,np.roll(x,1)))
+    return _polyarea(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
 
-def locate(struct_labels, frame=0):
+@njit(cache=True, fastmath=True)
+def _polyarea(x, y):
+    ''' single-pass Shoelace loop for `polyarea(...)`
+    '''
+    s = 0.0
+    n = x.shape[0]
+    for i in range(n):
+        j = i-1 if i else n-1
+        s += x[i]*y[j] - y[i]*x[j]
+    return 0.5*abs(s)
+
+def locate(struct_labels, frame=0, as_dataframe=True):
     ''' locate the positions structures and record the sizes, as well as which frame the structures are located
     PARAMETERS
         struct_labels:  (numpy.array) labels of structures, same size of the image, obtained from `find_structs(...)`
         frame:          (int) the corresponding frame of `struct_labels`
+        as_dataframe:   (bool) return a DataFrame if True, otherwise the raw arrays (cheaper when combining many frames)
     RETURNS
-        structs:        (pandas.DataFrame) position and size of the np-structures, with columns=['x','y','size','frame']
+        if as_dataframe is True:
+          structs:      (pandas.DataFrame) position and size of the np-structures, with columns=['x','y','size','frame']
+        if as_dataframe is False:
+          structs:      tuple of (xy, size, frame), where xy is a (n,2) numpy.array of positions and size a (n,) numpy.array
     '''
-    contours = skimage.measure.find_contours(struct_labels, 0)
-    res = []
-    for contour in contours:
-        res.append([np.mean(contour[:,0]), 
-                    np.mean(contour[:,1]),
-                    polyarea(contour[:,0], contour[:,1]),
-                    frame])
-    if len(res)>0:
-        res = np.array(res)
-        res = pd.DataFrame(res, columns=['x','y','size','frame'])
+    props = skimage.measure.regionprops_table(struct_labels, properties=('label','centroid','area'))
+    if not as_dataframe:
+        xy = np.stack([props['centroid-0'], props['centroid-1']], axis=1)
+        return (xy, props['area'], frame)
+    if len(props['label'])>0:
+        res = pd.DataFrame({'x': props['centroid-0'],
+                            'y': props['centroid-1'],
+                            'size': props['area'],
+                            'frame': frame})
         res = res.astype({'frame':'int'})
         return res
     else:
@@ -242,35 +375,152 @@ def get_starting_frame(frames, threshold=500):
     RETURNS
         starting_frame: (int) the starting frame when the shutter is open (not the first frame when np-structures are formed)
     '''
-    for i in range(len(frames)-1):
-        if np.max(frames[i]) < threshold and np.max(frames[i+1])>=threshold:
-            return (i+1)
+    if len(frames) == 0:
+        return None
+    # keep the max of the previous frame so that each frame is scanned only once
+    prev = frames[0].max()
+    for i in range(1, len(frames)):
+        cur = frames[i].max()
+        if prev < threshold and cur >= threshold:
+            return i
+        prev = cur
 
 def locate_nps_single_image(
         raw_image, frame_id, ball_size=9, sigma=1,
         times=2, scfactor=1e5, threshold=180,
-        dilation_size=1, erosion_size=5, min_struct_size=32):
+        dilation_size=1, erosion_size=5, min_struct_size=32, out=None, as_dataframe=True):
     ''' wrapper for locating nps in a single image - needed for locate_nps_multiple_images
+    `out` is passed to `preprocess_image(...)` for reusing its buffers across frames,
+    `as_dataframe` is passed to `locate(...)`
     '''
     bwimage = preprocess_image(raw_image, ball_size=ball_size, sigma=sigma,
                                 times=times, scfactor=scfactor, threshold=threshold,
-                                output_detail=False)
+                                output_detail=False, out=out)
     struct_labels = find_structs(bwimage, dilation_size=dilation_size,
                                     erosion_size=erosion_size, min_struct_size=min_struct_size,
                                     output_detail=False)
-    structs = locate(struct_labels, frame=frame_id)
+    structs = locate(struct_labels, frame=frame_id, as_dataframe=as_dataframe)
     return (structs, struct_labels)
 
+# pims readers that are fully described by their file name (no constructor options or state),
+# so that the workers can reopen them and get exactly the same frames
+_REOPENABLE_READERS = tuple(r for r in (getattr(pims, n, None)
+                            for n in ('TiffStack_tifffile', 'TiffStack_pil', 'TiffStack_libtiff'))
+                            if r is not None)
+
+@functools.lru_cache(maxsize=1)
+def _open_movie(reader, filename):
+    ''' open a movie with a pims reader, cached so that each worker process opens it only once
+    '''
+    return reader(filename)
+
+@functools.lru_cache(maxsize=1)
+def _attach_shared_memory(name):
+    ''' attach to a shared memory block, cached so that each worker process attaches only once
+    '''
+    return shared_memory.SharedMemory(name=name)
+
+def _copy_to_shared_memory(images):
+    ''' copy the frames of `images` one by one into a new shared memory block
+    Returns (shm, source) with source as needed by `_load_frame(...)`,
+    or (None, None) if there are no frames or the frames differ in shape or dtype.
+    '''
+    n_frames = len(images)
+    shm = None
+    try:
+        for f, img in enumerate(images):
+            img = np.asarray(img)
+            if shm is None:
+                shape, dtype = img.shape, img.dtype
+                shm = shared_memory.SharedMemory(create=True, size=max(n_frames*img.nbytes, 1))
+            if img.shape != shape or img.dtype != dtype:
+                shm.close()
+                shm.unlink()
+                return (None, None)
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=f*img.nbytes)[...] = img
+    except BaseException:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        raise
+    if shm is None:
+        return (None, None)
+    return (shm, ('shm', shm.name, (n_frames,)+shape, dtype.str))
+
+def _load_frame(source, frame_id):
+    ''' load a frame in a worker from `source`, which is one of ('pims', reader, filename),
+    ('shm', name, shape, dtype), or ('frame', image) for a frame passed along with the task
+    '''
+    if source[0] == 'frame':
+        return source[1]
+    if source[0] == 'pims':
+        return _open_movie(source[1], source[2])[frame_id]
+    _, name, shape, dtype = source
+    shm = _attach_shared_memory(name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)[frame_id]
+
+# preprocess buffers of a worker process, reused for all the frames it handles
+_worker_buffers = {}
+
+def _locate_nps_worker(args):
+    ''' worker for locate_nps_multiple_images - returns the frame id together with the result
+    '''
+    source, frame_id, params, as_dataframe = args
+    raw_image = _load_frame(source, frame_id)
+    return (frame_id, locate_nps_single_image(raw_image, frame_id, *params,
+                                              out=_worker_buffers, as_dataframe=as_dataframe))
+
 def locate_nps_multiple_images(
         images, ball_size=9, sigma=1,
         times=2, scfactor=1e5, threshold=180,
-        dilation_size=1, erosion_size=5, min_struct_size=32):
+        dilation_size=1, erosion_size=5, min_struct_size=32, concat=False):
     ''' locate nps in multiple images using multiprocessing
+    The frames are not pickled to the workers: if `images` is a tiff stack opened by `pims.open(...)`,
+    the workers reopen the file and read the frames themselves; otherwise the frames are copied
+    one by one into a shared memory block that all workers read from. Only if the frames differ
+    in shape or dtype, or if `images` has no length (e.g. a generator of frames), are they sent
+    to the workers with each task.
+    RETURNS
+        if concat is False:
+          results:  list of (structs, struct_labels) for each frame, see `locate_nps_single_image(...)`
+        if concat is True:
+          (structs, struct_labels): structs is a single pandas.DataFrame for all the frames,
+                    with columns=['x','y','size','frame'], and struct_labels is a list of the labels of each frame
     '''
-    args = [(img, f, ball_size, sigma, times, scfactor, threshold,dilation_size, erosion_size, min_struct_size) for f, img in enumerate(images)]
-    pool = mps.Pool(mps.cpu_count())
-    results = pool.starmap(locate_nps_single_image, args)
-    pool.close()
-    return results
-
-
+    params = (ball_size, sigma, times, scfactor, threshold, dilation_size, erosion_size, min_struct_size)
+    shm = None
+    # pims readers keep the file name either in `filename` or in `_filename`
+    filename = getattr(images, 'filename', getattr(images, '_filename', None))
+    if type(images) in _REOPENABLE_READERS and isinstance(filename, str):
+        source = ('pims', type(images), filename)
+    elif not hasattr(images, '__len__'):
+        # e.g. a generator: the frames are collected and sent with each task
+        images = list(images)
+        source = None
+    else:
+        shm, source = _copy_to_shared_memory(images)
+    n_frames = len(images)
+    ncpu = mps.cpu_count()
+    chunksize = max(1, n_frames//(4*ncpu))
+    if source is None:
+        args = ((('frame', img), f, params, not concat) for f, img in enumerate(images))
+    else:
+        args = ((source, f, params, not concat) for f in range(n_frames))
+    try:
+        with mps.Pool(ncpu) as pool:
+            results = list(pool.imap_unordered(_locate_nps_worker, args, chunksize=chunksize))
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    # restore the order of frames
+    results.sort(key=lambda r: r[0])
+    results = [r[1] for r in results]
+    if not concat:
+        return results
+    # build a single DataFrame from the arrays of all the frames
+    xy = np.concatenate([np.empty((0,2))]+[structs[0] for structs, _ in results])
+    sizes = np.concatenate([np.empty(0)]+[structs[1] for structs, _ in results])
+    frames = np.concatenate([np.empty(0, dtype=int)]+[np.full(len(structs[1]), structs[2], dtype=int) for structs, _ in results])
+    structs = pd.DataFrame({'x': xy[:,0], 'y': xy[:,1], 'size': sizes, 'frame': frames})
+    return (structs, [struct_labels for _, struct_labels in results])
@@ -4,10 +4,10 @@ Convert SRM results from matlab to python
 All rights reserved (c) 2019 Yong Wang
 '''
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import scipy.io as sio
 from matplotlib import path
-import copy
 import sys
 
 def progressbar(count, total, status=''):
@@ -28,41 +28,29 @@ def get_bac_boundary(ox=0, oy=0, theta=0,
     is at (ox, oy). The orientation of the bacterium is with an angle of 
     theta (in rad). The width and height are specified too.
     '''
-    vx= list()
-    vy= list()
+    v = np.empty((200,2))
     # top
     xc=(width-height)/2.0
-    x=np.linspace(-xc,xc,50)
-    y=x*0+height/2.0
-    vx = vx + x.tolist()
-    vy = vy + y.tolist()
+    v[0:50,0] = np.linspace(-xc,xc,50)
+    v[0:50,1] = height/2.0
     # right circle
     th = np.linspace(np.pi/2, -np.pi/2, 50)
-    x = height/2.0*np.cos(th)+xc
-    y = height/2.0*np.sin(th)
-    vx = vx + x.tolist()
-    vy = vy + y.tolist()
+    v[50:100,0] = height/2.0*np.cos(th)+xc
+    v[50:100,1] = height/2.0*np.sin(th)
     # bottom
-    x = np.linspace(xc,-xc,50)
-    y = x*0-height/2
-    vx = vx + x.tolist()
-    vy = vy + y.tolist()
+    v[100:150,0] = np.linspace(xc,-xc,50)
+    v[100:150,1] = -height/2.0
     # left cicle
     th = np.linspace( 3*np.pi/2, np.pi/2, 50)
-    x = height/2*np.cos(th)-xc
-    y = height/2*np.sin(th)
-    vx = vx + x.tolist()
-    vy = vy + y.tolist()
+    v[150:200,0] = height/2.0*np.cos(th)-xc
+    v[150:200,1] = height/2.0*np.sin(th)
     # rotate
-    v = np.array([vx,vy]).transpose()
     Rot = np.array([ [np.cos(theta), np.sin(theta)],
                         [-np.sin(theta), np.cos(theta)]])
-    v = np.matmul(v, Rot)
-    vx = v[:,0]
-    vy = v[:,1]
+    v = v @ Rot
     # shift
-    vx = vx + ox
-    vy = vy + oy
+    vx = v[:,0] + ox
+    vy = v[:,1] + oy
     return (vx, vy)
 
 def test_get_bac_boundary():
@@ -90,8 +78,13 @@ def load_srmseg_proj(sspfn='filename.srmseg_proj.mat', margin=-10):
     output = list()
     if sspfn.endswith('.srmseg_proj.mat'):
         # load in localization data
-        locs = np.loadtxt(sspfn[:-16])
-        xys = list(zip(locs[:,0], locs[:,1])) # for determining if locs are in each cell
+        try:
+            # the C parser of pandas is much faster than np.loadtxt for large files
+            locs = pd.read_csv(sspfn[:-16], sep=r'\s+', header=None, comment='#',
+                               engine='c', dtype=np.float64, float_precision='round_trip').to_numpy()
+        except (ValueError, pd.errors.ParserError):
+            locs = np.loadtxt(sspfn[:-16])
+        xys = np.ascontiguousarray(locs[:,:2]) # for determining if locs are in each cell
         # load in srmseg_proj.mat data
         lbc = sio.loadmat(sspfn)['project']['LocByCell'][0][0]
         # go through all cells
@@ -104,9 +97,14 @@ def load_srmseg_proj(sspfn='filename.srmseg_proj.mat', margin=-10):
             theta = c['theta'][0][0][0]
             # determine the boundary (note that the vx,vy in the mat are not updated)
             vx, vy = get_bac_boundary(ox, oy, theta, width, height)
-            vp = path.Path(list(zip(vx,vy)))
-            incell = vp.contains_points(xys, radius=margin)
-            idx = np.argwhere(incell)[:,0]
+            vp = path.Path(np.column_stack((vx,vy)))
+            # only test the locs within the bounding box of the cell (padded by the margin)
+            pad = np.abs(margin)
+            inbox = np.flatnonzero(np.logical_and.reduce((
+                        xys[:,0] >= vx.min()-pad, xys[:,0] <= vx.max()+pad,
+                        xys[:,1] >= vy.min()-pad, xys[:,1] <= vy.max()+pad)))
+            incell = vp.contains_points(xys[inbox], radius=margin)
+            idx = inbox[incell]
             if len(idx)>0:
                 loc = locs[idx,:]
                 cell = {'sspfn': sspfn, 'locfn': sspfn[:-16],
@@ -126,18 +124,11 @@ def translate_rotate_cell(cell):
     translate the cell to origin (0,0) and rotate the cell such that the 
     long axis is along the x-axis.
     '''
-    newcell = copy.deepcopy(cell)
-    ox = newcell['ox']
-    oy = newcell['oy']
-    theta = newcell['theta']
-    loc = newcell['loc']
-    pos = loc[:,[0,1]]
-    pos[:,0] = pos[:,0] - ox
-    pos[:,1] = pos[:,1] - oy
+    newcell = {**cell} # only loc is modified, other fields are shared with cell
+    loc = cell['loc'].copy()
+    theta = cell['theta']
     R = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-    pos = np.matmul(pos,R)
-    loc[:,0] = pos[:,0]
-    loc[:,1] = pos[:,1]
+    loc[:,:2] = (loc[:,:2] - np.array([cell['ox'], cell['oy']])) @ R
     newcell['ox'] = 0
     newcell['oy'] = 0
     newcell['theta'] = 0
@@ -6,51 +6,68 @@
 import os
 import sys
 import getopt
+import shutil
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy
 
 def look_for_valid_tifs(pd='./'):    
     if not pd.endswith(os.sep):
         pd = pd + os.sep
     valid_tifs = []
-    fns=os.listdir(pd)    
-    for fn in fns:
-       if not fn.startswith('.'):
-           ffn = pd+fn
-           if os.path.isdir(ffn):
-               vfs = look_for_valid_tifs(ffn)
-               if len(vfs) > 0:
-                   for f in vfs:
-                       valid_tifs.append(f)
-           if os.path.isfile(ffn) and ffn.endswith('.tif'):
-               if os.path.getsize(ffn) > 200*1024*1024: #> 200M
-                   valid_tifs.append(ffn)
+    # DirEntry caches the file type and stat info, saving syscalls per entry
+    with os.scandir(pd) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                valid_tifs.extend(look_for_valid_tifs(entry.path))
+            elif entry.is_file() and entry.name.endswith('.tif'):
+                if entry.stat().st_size > 200*1024*1024: #> 200M
+                    valid_tifs.append(entry.path)
     return valid_tifs               
 
-def copy_loc_files(source_dir, dest_dir, threshold):
+def copy_loc_files(source_dir, dest_dir, threshold, max_workers=8):
     if not source_dir.endswith(os.sep):
         source_dir = source_dir + os.sep
     if not dest_dir.endswith(os.sep):
         dest_dir = dest_dir + os.sep
     # 
     valid_tifs = look_for_valid_tifs(source_dir)
-    cnt = 0
+    pairs = []
     for vf in valid_tifs:        
         locfn = vf[:-3]+'RapidSTORM.th'+str(threshold)+'.txt'
-        if os.path.exists(locfn):
-            print('Copying %s...'%locfn)
-            newlocfn = locfn.replace('/', '_')
-            dfn = dest_dir+newlocfn
-            to_copy = True
-            if os.path.exists(dfn):
-              info_old = os.stat(locfn)
-              info_new = os.stat(dfn)
-              if info_old.st_size == info_new.st_size:
-                to_copy = False
-                print('\tSkiped.')
-            if to_copy:
-              os.system('cp '+locfn+' '+dfn)
-              cnt = cnt+1
-              print('\tCopied.')
+        try:
+            info_old = os.stat(locfn)
+        except FileNotFoundError:
+            continue
+        print('Copying %s...'%locfn)
+        newlocfn = locfn.replace('/', '_')
+        dfn = dest_dir+newlocfn
+        try:
+            info_new = os.stat(dfn)
+        except FileNotFoundError:
+            info_new = None
+        # skip if the copy has the same size and modification time as the source
+        if (info_new is not None and
+                (info_new.st_size, info_new.st_mtime) == (info_old.st_size, info_old.st_mtime)):
+            print('\tSkiped.')
+            continue
+        pairs.append((locfn, dfn, info_old))
+    # copy in parallel - the copies are I/O bound and shutil releases the GIL
+    counter = itertools.count(1)
+    lock = threading.Lock()
+    def copy_one(pair):
+        locfn, dfn, info_old = pair
+        shutil.copyfile(locfn, dfn)
+        # give the copy the modification time of the source for the skip check above
+        os.utime(dfn, ns=(info_old.st_atime_ns, info_old.st_mtime_ns))
+        with lock:
+            print('\tCopied %s (%d/%d).' % (locfn, next(counter), len(pairs)))
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(copy_one, pairs))
+    cnt = len(pairs)
     print('Copied %d files.' % cnt)
     sys.stdout.flush()
 
@@ -7,6 +7,30 @@ import os
 import sys
 import getopt
 import numpy
+import asyncio
+import subprocess
+import multiprocessing as mps
+from concurrent.futures import ThreadPoolExecutor
+
+def rapidstorm_cmd(inputfile, pixsize=160.0, threshold=5000):
+    '''
+    Build the rapidstorm command (as an argument list, no shell needed) for
+    inputfile. See single_run_rapidstorm for the parameters.
+    Returns (cmd, basename).
+    '''
+    # base name
+    basename=inputfile[:-4]+'.RapidSTORM.th'+str(threshold)
+    # rapidstorm configuration filename
+    configfile=inputfile[:-4]+'.RapidSTORM.th'+str(threshold)+'.config.txt'
+    # cmd
+    cmd=['rapidstorm', '--AmplitudeThreshold', '%d'%threshold, '--AutoTerminate',
+         '--Basename', basename, '--ChannelCount', '1', '--FileType', 'TIFF',
+         '--FItWindowSize', '600', '--FreeSigmaFitting', '--InputFile', inputfile,
+         '--InputMethod', 'FileMethod', '--NonMaximumSuppressi', '3',
+         '--OutputSigmas', '--PixelSizeInNM', '%.1f,%.1f'%(pixsize, pixsize),
+         '--SaveConfigFile', configfile, '--ChooseTransmission', 'Table',
+         '--ChooseTransmission', 'Count', '--Run']
+    return (cmd, basename)
 
 def single_run_rapidstorm(inputfile, pixsize=160.0, threshold=5000):
     '''
@@ -20,35 +44,69 @@ def single_run_rapidstorm(inputfile, pixsize=160.0, threshold=5000):
     *threshold*
         threshold that will be used in rapidstorm.
     '''
-    # base name
-    basename=inputfile[:-4]+'.RapidSTORM.th'+str(threshold)
-    # rapidstorm configuration filename
-    configfile=inputfile[:-4]+'.RapidSTORM.th'+str(threshold)+'.config.txt'
-    # cmdline
-    cmdline=('rapidstorm --AmplitudeThreshold %d --AutoTerminate'
-             +' --Basename %s --ChannelCount 1 --FileType TIFF'
-             +' --FItWindowSize 600 --FreeSigmaFitting --InputFile "%s"'
-             +' --InputMethod FileMethod --NonMaximumSuppressi 3'
-             +' --OutputSigmas --PixelSizeInNM %4.1f,%4.1f'
-             +' --SaveConfigFile %s --ChooseTransmission Table'
-             +' --ChooseTransmission Count --Run'  
-             )%(threshold, basename, inputfile, pixsize, pixsize, configfile)
+    cmd, basename = rapidstorm_cmd(inputfile, pixsize, threshold)
     print('> single_run_rapidstorm:')
     print('>> Input      = %s'%inputfile)
     print('>> pixsize    = %4.1f'%pixsize)
     print('>> threshold  = %d'%threshold)
     
-    ret = os.system(cmdline)
+    try:
+        ret = subprocess.call(cmd)
+    except OSError as e:
+        print('> %s'%e)
+        ret = 127
     if ret == 0:
         print('> Succeeded.')
         print('')
     else:
         print('> Failed.')
         print('')
+
+async def async_run_rapidstorm(inputfile, pixsize, threshold, sem):
+    '''
+    Run rapidstorm for inputfile once sem (asyncio.Semaphore) is acquired.
+    The output of rapidstorm goes to <basename>.log instead of the terminal.
+    Returns the exit code of rapidstorm (127 if rapidstorm could not be started).
+    '''
+    cmd, basename = rapidstorm_cmd(inputfile, pixsize, threshold)
+    async with sem:
+        print('> Running rapidstorm: %s (threshold = %d)'%(inputfile, threshold))
+        with open(basename+'.log', 'w') as log:
+            proc = None
+            try:
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=log, stderr=subprocess.STDOUT)
+                ret = await proc.wait()
+            except OSError as e:
+                log.write('%s\n'%e)
+                ret = 127
+            finally:
+                # do not leave rapidstorm running if the scan is cancelled
+                if proc is not None and proc.returncode is None:
+                    proc.kill()
+                    await asyncio.shield(proc.wait())
+    if ret == 0:
+        print('> Succeeded: %s (threshold = %d)'%(inputfile, threshold))
+    else:
+        print('> Failed: %s (threshold = %d), see %s'%(inputfile, threshold, basename+'.log'))
+    return ret
     
-def scan_thresholds_run_rapidstorm(inputfile, pixsize=160.0, thresholds=range(20000,1000-1,-1000)):
-    for th in thresholds:
-        single_run_rapidstorm(inputfile, pixsize, th)
+def scan_thresholds_run_rapidstorm(inputfile, pixsize=160.0, thresholds=range(20000,1000-1,-1000), n_jobs=None):
+    '''
+    Run rapidstorm for inputfile for all thresholds, with up to n_jobs
+    (default: number of CPUs) runs at the same time.
+    '''
+    if n_jobs is None:
+        n_jobs = mps.cpu_count()
+    async def driver():
+        sem = asyncio.Semaphore(n_jobs)
+        return await asyncio.gather(*[async_run_rapidstorm(inputfile, pixsize, th, sem) for th in thresholds])
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(driver())
+    # called from a running event loop (e.g. Jupyter): run the scan in its own thread and loop
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(lambda: asyncio.run(driver())).result()
 
 
 def run_experiment(experiment, pixsize=160.0, thresholds=range(20000,1000-1,-1000)):
@@ -63,18 +121,16 @@ def look_for_valid_tifs(pd='./'):
     if not pd.endswith(os.sep):
         pd = pd + os.sep
     valid_tifs = []
-    fns=os.listdir(pd)    
-    for fn in fns:
-       if not fn.startswith('.'):
-           ffn = pd+fn
-           if os.path.isdir(ffn):
-               vfs = look_for_valid_tifs(ffn)
-               if len(vfs) > 0:
-                   for f in vfs:
-                       valid_tifs.append(f)
-           if os.path.isfile(ffn) and ffn.endswith('.tif'):
-               if os.path.getsize(ffn) > 200*1024*1024: #> 200M
-                   valid_tifs.append(ffn)
+    # DirEntry caches the file type and stat info, saving syscalls per entry
+    with os.scandir(pd) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                valid_tifs.extend(look_for_valid_tifs(entry.path))
+            elif entry.is_file() and entry.name.endswith('.tif'):
+                if entry.stat().st_size > 200*1024*1024: #> 200M
+                    valid_tifs.append(entry.path)
     return valid_tifs
                
     
@@ -136,11 +192,11 @@ def main(argv):
         elif opt in ('-p', '--pixsize'):
             pixsize = float(arg)
     
-    print 'pd       : %s'%pd
-    print 'pixsize  : %f'%pixsize
-    print 'min_th   : %d'%min_th
-    print 'max_th   : %d'%max_th
-    print 'delta_th : %d'%delta_th
+    print('pd       : %s'%pd)
+    print('pixsize  : %f'%pixsize)
+    print('min_th   : %d'%min_th)
+    print('max_th   : %d'%max_th)
+    print('delta_th : %d'%delta_th)
     
     ths = range(max_th, min_th-1, -delta_th)
     run_for_dir(pd, pixsize, ths)